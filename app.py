@@ -2,18 +2,40 @@
 from dotenv import load_dotenv
 # Importa el módulo os para interactuar con el sistema operativo  
 import os
+# Importa el módulo hashlib para calcular huellas de los trozos de texto
+import hashlib
+# Importa el módulo logging para registrar las páginas que PyPDF2 no puede leer
+import logging
+# Importa el módulo re para normalizar los espacios del texto extraído
+import re
+# Importa el módulo shelve para guardar en disco la caché de incrustaciones
+import shelve
+# Importa la clase Path del módulo pathlib para manejar rutas de archivos
+from pathlib import Path
+# Importa BytesIO para dar al procesamiento en segundo plano su propia copia del archivo
+from io import BytesIO
+# Importa ThreadPoolExecutor para lanzar varias peticiones a la API a la vez
+from concurrent.futures import ThreadPoolExecutor
+# Importa el módulo threading para proteger las cachés en disco de escrituras simultáneas
+import threading
+# Importa el módulo time para esperar entre comprobaciones del procesamiento en segundo plano
+import time
 # Importa la clase PdfReader del módulo PyPDF2 para leer archivos PDF  
 from PyPDF2 import PdfReader
+# Importa pypdfium2 para leer los PDF en los que PyPDF2 es demasiado lento o falla
+import pypdfium2 as pdfium
 # Importa la biblioteca Streamlit para crear aplicaciones web interactivas  
 import streamlit as st  
-# Importa el CharacterTextSplitter del módulo langchain.text_splitter para dividir texto en caracteres
-from langchain.text_splitter import CharacterTextSplitter  
+# Importa el RecursiveCharacterTextSplitter del módulo langchain.text_splitter para dividir texto en trozos
+from langchain.text_splitter import RecursiveCharacterTextSplitter  
 # Importa OpenAIEmbeddings del módulo langchain.embeddings.openai para generar incrustaciones de texto utilizando OpenAI
 from langchain.embeddings.openai import OpenAIEmbeddings  
 # Importa FAISS del módulo langchain para realizar búsqueda de similitud
 from langchain import FAISS  
 # Importa load_qa_chain del módulo langchain.chains.question_answering para cargar cadenas de preguntas y respuestas
 from langchain.chains.question_answering import load_qa_chain  
+# Importa PromptTemplate del módulo langchain.prompts para definir la plantilla de la pregunta
+from langchain.prompts import PromptTemplate
 # Importa OpenAI del módulo langchain.llms para interactuar con el modelo de lenguaje de OpenAI
 from langchain.llms import OpenAI  
 # Importa get_openai_callback del módulo langchain.callbacks para obtener realimentación de OpenAI
@@ -24,45 +46,339 @@ import langchain
 # Desactiva la salida detallada de la biblioteca langchain
 langchain.verbose = False  
 
-# Carga las variables de entorno desde un archivo .env
-load_dotenv()
+# Número de trozos que se envían a OpenAI en cada petición de incrustaciones
+EMBED_BATCH_SIZE = 1000
+
+# Número máximo de peticiones de incrustaciones que se hacen a la vez
+EMBED_WORKERS = 4
+
+# Divide el texto en trozos usando langchain, probando primero los cortes por párrafo, línea y frase
+# (un solapamiento del 15 % genera menos trozos que incrustar que el 20 % anterior)
+text_splitter = RecursiveCharacterTextSplitter(
+  separators=["\n\n", "\n", ". ", " ", ""],
+  # Sin esto, cada separador pasa al principio del trozo siguiente (trozos que empiezan por ". ")
+  keep_separator=False,
+  chunk_size=1000,
+  chunk_overlap=150,
+  length_function=len
+)
+
+# Parámetros de la búsqueda MMR: de los 20 trozos más parecidos se eligen 4 que no se repitan entre sí
+SEARCH_KWARGS = {"k": 4, "fetch_k": 20, "lambda_mult": 0.5}
+
+# Plantilla de la pregunta: las instrucciones fijas van al principio para que el prefijo sea siempre el mismo
+QA_PROMPT = PromptTemplate(
+  template=(
+    "Eres un asistente que responde en español a preguntas sobre un documento PDF. "
+    "Usa solo el siguiente contexto; si la respuesta no está en él, dilo.\n\n"
+    "Contexto:\n{context}\n\n"
+    "Pregunta: {question}\n"
+    "Respuesta en español:"
+  ),
+  input_variables=["context", "question"]
+)
+
+# Archivo donde se guardan las incrustaciones ya calculadas
+EMBED_CACHE_PATH = "emb_cache.db"
+
+# Directorio donde se guarda el texto ya extraído de cada PDF
+CACHE_DIR = Path("cache")
+
+# Prepara el entorno una sola vez por proceso y no en cada ejecución del script
+@st.cache_resource
+def setup():
+  # Carga las variables de entorno desde un archivo .env
+  load_dotenv()
+
+  # Crea el directorio de la caché si todavía no existe
+  CACHE_DIR.mkdir(exist_ok=True)
+
+# Tamaño de los bloques con los que se lee el archivo al calcular su huella
+HASH_BLOCK_SIZE = 1 << 20
+
+# Función para calcular la huella de un archivo PDF leyéndolo por bloques
+# (file_digest usaría getbuffer(), que obliga a copiar entero el archivo subido)
+def hash_file(file):
+  file_hash = hashlib.blake2b(digest_size=32)
+
+  while block := file.read(HASH_BLOCK_SIZE):
+    file_hash.update(block)
+
+  # Vuelve al inicio para que el archivo se pueda leer de nuevo
+  file.seek(0)
+
+  return file_hash.hexdigest()
+
+# Archivo con las huellas de los PDF en caché, guardadas como 32 bytes binarios seguidos
+HASH_INDEX_PATH = CACHE_DIR / "hashes.bin"
+HASH_SIZE = 32
+
+# Nombres válidos de los textos en caché: la huella en hexadecimal (64 caracteres)
+HASH_NAME_RE = re.compile(r"[0-9a-f]{64}")
+
+# Carga una sola vez por proceso el conjunto de huellas de los PDF ya procesados
+@st.cache_resource
+def cached_hashes():
+  if not HASH_INDEX_PATH.exists():
+    # Crea el índice a partir de los textos que ya estaban en la caché, ignorando otros archivos
+    stems = (path.stem for path in CACHE_DIR.glob("*.txt"))
+    HASH_INDEX_PATH.write_bytes(b"".join(bytes.fromhex(stem) for stem in stems if HASH_NAME_RE.fullmatch(stem)))
+
+  data = HASH_INDEX_PATH.read_bytes()
+
+  return {data[i:i + HASH_SIZE] for i in range(0, len(data), HASH_SIZE)}
+
+# Función para comprobar si el texto de un PDF ya está en la caché
+def is_cached(file_hash, hashes):
+  return bytes.fromhex(file_hash) in hashes
+
+# Función para guardar en la caché el texto extraído de un PDF
+def save_text(file_hash, text, hashes):
+  (CACHE_DIR / f"{file_hash}.txt").write_text(text, encoding="utf-8")
+
+  # Añade la huella al índice solo después de guardar el texto
+  # (ya puede estar si se volvió a extraer un texto borrado de la caché)
+  digest = bytes.fromhex(file_hash)
+
+  if digest not in hashes:
+    with HASH_INDEX_PATH.open("ab") as index:
+      index.write(digest)
+
+    hashes.add(digest)
+
+# Crea una sola vez por proceso el cliente de incrustaciones de OpenAI
+@st.cache_resource
+def get_embeddings():
+  return OpenAIEmbeddings(openai_api_key=os.environ.get("OPENAI_API_KEY"), chunk_size=EMBED_BATCH_SIZE)
+
+# Crea una sola vez por proceso el modelo de lenguaje de OpenAI
+@st.cache_resource
+def get_llm():
+  # Inicializa un modelo de lenguaje de OpenAI y ajustamos sus parámetros
+  model = "gpt-3.5-turbo-instruct" # Acepta 4096 tokens
+  temperature = 0  # Valores entre 0 - 1
+
+  return OpenAI(openai_api_key=os.environ.get("OPENAI_API_KEY"), model_name=model, temperature=temperature)
+
+# Crea una sola vez por proceso la cadena de preguntas y respuestas con su plantilla
+@st.cache_resource
+def get_qa_chain():
+  return load_qa_chain(get_llm(), chain_type="stuff", prompt=QA_PROMPT)
+
+# Función para calcular las incrustaciones de los trozos reutilizando las que ya están en caché
+# (el cerrojo solo se toma para leer y escribir la caché, no durante las peticiones a la API)
+def embed_chunks(chunks, embeddings, cache_lock):
+  # La clave incluye el modelo para no mezclar vectores de modelos distintos
+  keys = [hashlib.blake2b(f"{embeddings.model}:{chunk}".encode(), digest_size=16).hexdigest() for chunk in chunks]
+
+  with cache_lock, shelve.open(EMBED_CACHE_PATH) as cache:
+    vectors = [cache.get(key) for key in keys]
+
+  # Solo se envían a la API los trozos que no están en la caché
+  misses = [i for i, vector in enumerate(vectors) if vector is None]
+
+  if not misses:
+    return vectors
+
+  batches = [misses[start:start + EMBED_BATCH_SIZE] for start in range(0, len(misses), EMBED_BATCH_SIZE)]
+
+  # Lanza los lotes en paralelo
+  with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as executor:
+    results = executor.map(embeddings.embed_documents, [[chunks[i] for i in batch] for batch in batches])
+
+    for batch, batch_vectors in zip(batches, results):
+      for i, vector in zip(batch, batch_vectors):
+        vectors[i] = vector
+
+  with cache_lock, shelve.open(EMBED_CACHE_PATH) as cache:
+    for i in misses:
+      cache[keys[i]] = vectors[i]
+
+  # Devuelve los vectores en el mismo orden que los trozos
+  return vectors
+
+# Bytes del principio del archivo en los que se busca la cabecera "%PDF-"
+PDF_HEADER_SEARCH_SIZE = 1024
+
+# Expresiones para separar párrafos (líneas en blanco) y para encontrar espacios repetidos
+PARAGRAPH_BREAK_RE = re.compile(r"\n[^\S\n]*\n\s*")
+WHITESPACE_RE = re.compile(r"\s+")
+
+# Función para compactar los espacios, saltos de línea y saltos de página, manteniendo los párrafos
+def normalize_whitespace(text):
+  paragraphs = (WHITESPACE_RE.sub(" ", paragraph).strip() for paragraph in PARAGRAPH_BREAK_RE.split(text))
+
+  return "\n\n".join(paragraph for paragraph in paragraphs if paragraph)
+
+# Segundos que puede tardar PyPDF2 en una página antes de pasar a pypdfium2 para el resto
+SLOW_PAGE_SECONDS = 0.5
+
+# Registro de la aplicación (avisos de extracción en segundo plano)
+logger = logging.getLogger(__name__)
+
+# Función para extraer el texto de todas las páginas de un archivo PDF
+def extract_text(pdf):
+  # Reúne el texto de cada página en una lista y lo une una sola vez al final
+  # (concatenar con += en el bucle copia el texto acumulado en cada página)
+  parts = []
+  pdf_reader = None
+  pdfium_doc = None
+
+  try:
+    try:
+      pdf_reader = PdfReader(pdf)
+      page_count = len(pdf_reader.pages)
+    except Exception as error:
+      # Si PyPDF2 no puede abrir el documento, se lee entero con pypdfium2
+      logger.warning("PyPDF2 no pudo abrir el PDF, se usa pypdfium2: %s", error)
+      pdf.seek(0)
+      pdfium_doc = pdfium.PdfDocument(pdf)
+      page_count = len(pdfium_doc)
+
+    for page_number in range(page_count):
+      text = None
+
+      if pdfium_doc is None:
+        start = time.perf_counter()
+
+        try:
+          text = pdf_reader.pages[page_number].extract_text()
+        except Exception as error:
+          logger.warning("PyPDF2 no pudo leer la página %d, se usa pypdfium2: %s", page_number + 1, error)
+
+        elapsed = time.perf_counter() - start
+
+        # Si PyPDF2 falla o va demasiado lento, el resto del documento se lee con pypdfium2
+        # (una página de PyPDF2 no se puede interrumpir, así que el cambio es para las siguientes)
+        if text is None or elapsed > SLOW_PAGE_SECONDS:
+          if text is not None:
+            logger.warning("PyPDF2 tardó %.1f s en la página %d, el resto se lee con pypdfium2", elapsed, page_number + 1)
+
+          pdfium_doc = pdfium.PdfDocument(pdf)
+
+      if text is None:
+        # Las dos bibliotecas pueden no contar las mismas páginas en un PDF dañado
+        if page_number >= len(pdfium_doc):
+          logger.warning("pypdfium2 solo encuentra %d de %d páginas, se omite el resto", len(pdfium_doc), page_count)
+          break
+
+        text = pdfium_doc[page_number].get_textpage().get_text_range()
+
+      # Las páginas sin texto (en blanco o escaneadas) se descartan
+      if text.strip():
+        parts.append(text)
+  finally:
+    if pdfium_doc is not None:
+      pdfium_doc.close()
+
+  # Cada página se separa como un párrafo y el resultado se normaliza una sola vez
+  return normalize_whitespace("\n\n".join(parts))
 
 # Función para procesar el texto extraído de un archivo PDF
-def process_text(text):
+def process_text(text, embeddings, cache_lock):
   # Divide el texto en trozos usando langchain
-  text_splitter = CharacterTextSplitter(
-    separator="\n",
-    chunk_size=1000,
-    chunk_overlap=200,
-    length_function=len
-  )
-
   chunks = text_splitter.split_text(text)
 
-  # Convierte los trozos de texto en incrustaciones para formar una base de conocimientos
-  embeddings = OpenAIEmbeddings(openai_api_key=os.environ.get("OPENAI_API_KEY"))
+  # Elimina los trozos repetidos (cabeceras, pies de página...) conservando el orden
+  chunks = list(dict.fromkeys(chunks))
+
+  # Sin trozos no hay vectores con los que crear el índice (PDF escaneado o sin texto)
+  if not chunks:
+    raise ValueError("el PDF no contiene texto que se pueda extraer")
+
+  # Convierte los trozos de texto en incrustaciones para formar una base de conocimientos,
+  # calculándolas por lotes y reutilizando las que ya se calcularon antes
+  vectors = embed_chunks(chunks, embeddings, cache_lock)
 
-  knowledge_base = FAISS.from_texts(chunks, embeddings)
+  knowledge_base = FAISS.from_embeddings(zip(chunks, vectors), embeddings)
 
   return knowledge_base
 
+# Función que lee un PDF (o su texto en caché) y construye su base de conocimientos
+# (se ejecuta en segundo plano, así que recibe ya creados los recursos de Streamlit que necesita)
+def index_pdf(pdf, file_hash, hashes, embeddings, cache_lock):
+  text = None
+
+  # Si el PDF ya se procesó antes, reutiliza su texto en lugar de volver a leerlo
+  if is_cached(file_hash, hashes):
+    try:
+      text = (CACHE_DIR / f"{file_hash}.txt").read_text(encoding="utf-8")
+    except FileNotFoundError:
+      # El texto se borró de la caché aunque su huella siga en el índice: se vuelve a extraer
+      pass
+
+  if text is None:
+    # Almacena el texto del PDF en una variable
+    text = extract_text(pdf)
+
+    with cache_lock:
+      save_text(file_hash, text, hashes)
+
+  # Crea un objeto de base de conocimientos a partir del texto del PDF
+  return process_text(text, embeddings, cache_lock)
+
+# Crea una sola vez por proceso los hilos que procesan los PDF en segundo plano
+@st.cache_resource
+def get_executor():
+  return ThreadPoolExecutor(max_workers=2)
+
+# Crea una sola vez por proceso el cerrojo de las cachés en disco
+# (la caché de incrustaciones y el índice de huellas solo admiten un escritor a la vez)
+@st.cache_resource
+def get_cache_lock():
+  return threading.Lock()
+
+# Función para lanzar en segundo plano el procesamiento del PDF de esta sesión si no se ha lanzado ya
+def start_indexing(pdf, file_hash):
+  if st.session_state.get("ingest_hash") != file_hash:
+    # El trabajo lee su propio flujo: el archivo del cargador se reutiliza en cada ejecución del script
+    st.session_state.ingest_future = get_executor().submit(
+      index_pdf, BytesIO(pdf.getvalue()), file_hash, cached_hashes(), get_embeddings(), get_cache_lock()
+    )
+    st.session_state.ingest_hash = file_hash
+
+  return st.session_state.ingest_future
+
 # Función principal de la aplicación
 def main():
+  setup()
+
   st.title("Preguntas a un PDF")  # Establece el título de la aplicación
 
   pdf = st.file_uploader("Sube tu archivo PDF", type="pdf")  # Crea un cargador de archivos para subir archivos PDF
 
   if pdf is not None:
-    pdf_reader = PdfReader(pdf)
-    
-    # Almacena el texto del PDF en una variable
-    text = ""
+    # Comprueba la cabecera antes de procesar el archivo (los lectores admiten basura antes de "%PDF-")
+    is_pdf = b"%PDF-" in pdf.read(PDF_HEADER_SEARCH_SIZE)
+    pdf.seek(0)
 
-    for page in pdf_reader.pages:
-      text += page.extract_text()
+    if not is_pdf:
+      st.error("El archivo subido no es un PDF válido.")
+      st.stop()
 
-    # Crea un objeto de base de conocimientos a partir del texto del PDF
-    knowledgeBase = process_text(text)
+    # Calcula la huella una sola vez por archivo subido, no en cada ejecución del script
+    if st.session_state.get("pdf_file_id") != pdf.file_id:
+      st.session_state.pdf_hash = hash_file(pdf)
+      st.session_state.pdf_file_id = pdf.file_id
+
+    file_hash = st.session_state.pdf_hash
+
+    # Procesa el PDF en segundo plano para no bloquear la aplicación
+    job = start_indexing(pdf, file_hash)
+
+    if not job.done():
+      st.info("Procesando el PDF...")
+      time.sleep(1)
+      st.rerun()  # Vuelve a ejecutar la aplicación para comprobar si ya terminó
+
+    if job.exception() is not None:
+      # Olvida el trabajo fallido para que se pueda volver a intentar
+      del st.session_state.ingest_hash
+      del st.session_state.ingest_future
+      st.error(f"No se pudo procesar el PDF: {job.exception()}")
+      st.stop()
+
+    knowledgeBase = job.result()
 
     # Caja de entrada de texto para que el usuario escriba su pregunta
     query = st.text_input('Escribe tu pregunta para el PDF...')
@@ -74,25 +390,23 @@ def main():
       st.stop()  # Detiene la ejecución de la aplicación
 
     if query:
-      # Realiza una búsqueda de similitud en la base de conocimientos
-      docs = knowledgeBase.similarity_search(query)
-
-      # Inicializa un modelo de lenguaje de OpenAI y ajustamos sus parámetros
-
-      model = "gpt-3.5-turbo-instruct" # Acepta 4096 tokens
-      temperature = 0  # Valores entre 0 - 1
-
-      llm = OpenAI(openai_api_key=os.environ.get("OPENAI_API_KEY"), model_name=model, temperature=temperature)
+      # Realiza una búsqueda de similitud en la base de conocimientos, descartando trozos casi repetidos
+      docs = knowledgeBase.max_marginal_relevance_search(query, **SEARCH_KWARGS)
 
       # Carga la cadena de preguntas y respuestas
-      chain = load_qa_chain(llm, chain_type="stuff")
+      chain = get_qa_chain()
 
       # Obtiene la realimentación de OpenAI para el procesamiento de la cadena
       with get_openai_callback() as cost:
         response = chain.invoke(input={"question": query, "input_documents": docs})
-        print(cost)  # Imprime el costo de la operación
 
-        st.write(response["output_text"])  # Muestra el texto de salida de la cadena de preguntas y respuestas en la aplicación
+      print(cost)  # Imprime el costo de la operación
+
+      st.write(response["output_text"])  # Muestra el texto de salida de la cadena de preguntas y respuestas en la aplicación
+  else:
+    # Sin PDF, libera la base de conocimientos de esta sesión
+    st.session_state.pop("ingest_hash", None)
+    st.session_state.pop("ingest_future", None)
 
 # Punto de entrada para la ejecución del programa
 if __name__ == "__main__":